@@ -16,8 +16,13 @@ Extract unique reward codes from QR codes on Zyn container backs via video.
 import os
 import sys
 import cv2
+import numpy as np
 import re
 import argparse
+import threading
+from ctypes import c_void_p, string_at
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 # Debug: print ZBar library lookup
 import ctypes.util
 # Common brew/homebrew and local paths for libzbar
@@ -49,6 +54,13 @@ if 'ZBAR_LIBRARY_PATH' not in os.environ:
 # Try to import pyzbar (ZBar). If unavailable or fails to load, fall back to OpenCV QRCodeDetector.
 try:
     from pyzbar.pyzbar import decode as pyzbar_decode, ZBarSymbol
+    from pyzbar.pyzbar_error import PyZbarError
+    from pyzbar.wrapper import (
+        ZBarConfig, zbar_image_scanner_create, zbar_image_scanner_destroy, zbar_image_scanner_set_config,
+        zbar_image_create, zbar_image_destroy, zbar_image_set_format, zbar_image_set_size, zbar_image_set_data,
+        zbar_scan_image, zbar_image_first_symbol, zbar_symbol_next,
+        zbar_symbol_get_data, zbar_symbol_get_data_length,
+    )
     have_pyzbar = True
 except ImportError as ie:
     have_pyzbar = False
@@ -59,39 +71,161 @@ except OSError as oe:
     zbar_path = os.environ.get('ZBAR_LIBRARY_PATH', '<not set>')
     print(f"Warning: could not load ZBar library at '{zbar_path}' ({oe}); ensure ZBAR_LIBRARY_PATH is correct. Falling back to OpenCV QRCodeDetector", file=sys.stderr)
     detector_cv = cv2.QRCodeDetector()
+def frame_to_gray(frame, threshold=None, dst=None):
+    """
+    Convert a BGR frame to grayscale. If threshold is given, the result is binarized:
+    pixels whose luminance is above threshold become white, the rest black.
+    Writes into dst if given.
+    """
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=dst)
+    if threshold is not None:
+        cv2.threshold(gray, threshold, 255, cv2.THRESH_BINARY, dst=gray)
+    return gray
+
+# Optional RE2 engine for custom code patterns (linear time, no backtracking), enabled with --re2
+try:
+    import re2
+    have_re2 = True
+except ImportError:
+    have_re2 = False
+
+_thread_state = threading.local()
+
+def _thread_buffer(name, shape):
+    """
+    Return this thread's uint8 scratch array called name, reallocated only when shape changes.
+    The contents are only valid until the same thread asks for the buffer again.
+    """
+    buf = getattr(_thread_state, name, None)
+    if buf is None or buf.shape != shape:
+        buf = np.empty(shape, dtype=np.uint8)
+        setattr(_thread_state, name, buf)
+    return buf
+
+def _resize_into(image, upsample, name):
+    """
+    Upsample image by an integer factor into this thread's scratch buffer called name.
+    Nearest-neighbour is enough for QR codes, whose modules are solid squares.
+    """
+    height, width = image.shape[:2]
+    size = (width * upsample, height * upsample)
+    dst = _thread_buffer(name, (size[1], size[0]) + image.shape[2:])
+    return cv2.resize(image, size, dst=dst, interpolation=cv2.INTER_NEAREST)
+
+# FourCC for 8-bit grayscale images ('Y800')
+_ZBAR_Y800 = ord('Y') | (ord('8') << 8) | (ord('0') << 16) | (ord('0') << 24)
 
-def extract_codes_from_frame(frame, code_regex, full_url=False, upsample=1):
+# Every thread's ZBar handles, so they can be released once decoding is done
+_zbar_handles = []
+_zbar_handles_lock = threading.Lock()
+
+def _zbar_qr_scanner():
+    """
+    Return this thread's persistent (scanner, image) pair of ZBar handles.
+    The scanner is configured once with every symbology but QR codes disabled;
+    pyzbar's decode() instead builds and configures a new scanner on every call.
+    """
+    handles = getattr(_thread_state, 'zbar', None)
+    if handles is None:
+        scanner = zbar_image_scanner_create()
+        zbar_image_scanner_set_config(scanner, ZBarSymbol.NONE, ZBarConfig.CFG_ENABLE, 0)
+        zbar_image_scanner_set_config(scanner, ZBarSymbol.QRCODE, ZBarConfig.CFG_ENABLE, 1)
+        image = zbar_image_create()
+        zbar_image_set_format(image, _ZBAR_Y800)
+        handles = _thread_state.zbar = (scanner, image)
+        with _zbar_handles_lock:
+            _zbar_handles.append(handles)
+    return handles
+
+def release_zbar_scanners():
+    """
+    Destroy the ZBar handles created by decode_qr_payloads. Only call this once no
+    thread will decode again, e.g. after the decode executor has shut down.
+    """
+    with _zbar_handles_lock:
+        for scanner, image in _zbar_handles:
+            zbar_image_destroy(image)
+            zbar_image_scanner_destroy(scanner)
+        _zbar_handles.clear()
+    _thread_state.__dict__.pop('zbar', None)
+
+def decode_qr_payloads(gray):
+    """
+    Decode QR codes in a 2-D uint8 image with this thread's ZBar scanner and
+    return the raw payload of each symbol as bytes.
+    """
+    scanner, image = _zbar_qr_scanner()
+    height, width = gray.shape
+    # Point ZBar straight at the array's memory (no-op unless gray is a strided view);
+    # pixels must stay alive until the scan below returns
+    pixels = np.ascontiguousarray(gray, dtype=np.uint8)
+    zbar_image_set_size(image, width, height)
+    zbar_image_set_data(image, pixels.ctypes.data_as(c_void_p), pixels.nbytes, None)
+    try:
+        if zbar_scan_image(scanner, image) < 0:
+            raise PyZbarError('Unsupported image format')
+        payloads = []
+        symbol = zbar_image_first_symbol(image)
+        while symbol:
+            payloads.append(string_at(zbar_symbol_get_data(symbol),
+                                      zbar_symbol_get_data_length(symbol)))
+            symbol = zbar_symbol_next(symbol)
+    finally:
+        # Don't leave the image pointing at pixels that are about to be freed
+        zbar_image_set_data(image, None, 0, None)
+    return payloads
+
+def extract_codes_from_frame(frame, code_match, full_url=False, upsample=1, gray=None,
+                             known_codes=(), threshold=None, seen_payloads=(), new_payloads=None):
     """
     Detect QR codes in frame and return set of code strings.
     If full_url is True, returns full decoded URLs; otherwise, returns only tail code segment matching regex.
+    code_match is called on each tail segment and must return a truthy value for valid codes
+    (see make_code_matcher).
+    If gray is given, it is used as the precomputed grayscale version of frame.
+    Codes already in known_codes are skipped before any regex work.
+    If threshold is given, the frame is binarized at that luminance before decoding.
+    Raw QR payloads in seen_payloads are skipped, so a code that stays in view across frames
+    is only parsed once. If new_payloads is a set, every payload parsed here is added to it;
+    seen_payloads itself is only read, so the caller decides when to record them.
     """
-    # Upsample to improve QR detection for small codes
-    if upsample and upsample > 1:
-        frame = cv2.resize(frame, None,
-                           fx=upsample, fy=upsample,
-                           interpolation=cv2.INTER_LINEAR)
     codes = set()
     if have_pyzbar:
         # Decode via ZBar (only QR codes)
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        decoded_objs = pyzbar_decode(gray, symbols=[ZBarSymbol.QRCODE])
-        for obj in decoded_objs:
+        if gray is None:
+            gray = frame_to_gray(frame, threshold, dst=_thread_buffer('gray', frame.shape[:2]))
+        # Upsample to improve QR detection for small codes
+        if upsample and upsample > 1:
+            gray = _resize_into(gray, upsample, 'upsampled')
+        # Collect unique payloads first: ZBar may report the same code more than once per frame
+        payloads = set(decode_qr_payloads(gray))
+        for data in payloads:
+            if data in seen_payloads:
+                continue
+            if new_payloads is not None:
+                new_payloads.add(data)
             try:
-                url = obj.data.decode('utf-8', errors='ignore')
+                url = data.decode('utf-8', errors='ignore')
             except Exception:
                 continue
             if full_url:
                 codes.add(url)
             else:
-                # Extract substring after last slash via regex
-                match = re.search(r'[^/]+$', url.strip())
-                if not match:
+                # Extract substring after last slash
+                code = url.strip().rsplit('/', 1)[-1]
+                if code in known_codes:
                     continue
-                code = match.group(0)
-                if code_regex.fullmatch(code):
+                if code and code_match(code):
                     codes.add(code)
     else:
-        # Fallback: OpenCV QRCodeDetector
+        # Fallback: OpenCV QRCodeDetector (accepts grayscale input too)
+        if gray is not None:
+            frame = gray
+        elif threshold is not None:
+            frame = frame_to_gray(frame, threshold, dst=_thread_buffer('gray', frame.shape[:2]))
+        # Upsample to improve QR detection for small codes
+        if upsample and upsample > 1:
+            frame = _resize_into(frame, upsample, 'upsampled')
         try:
             ok, decoded_info, _, _ = detector_cv.detectAndDecodeMulti(frame)
         except Exception:
@@ -99,28 +233,72 @@ def extract_codes_from_frame(frame, code_regex, full_url=False, upsample=1):
             decoded_info = [data] if data else []
             ok = bool(data)
         if ok:
-            for url in decoded_info:
+            for url in set(decoded_info):
                 if not url:
                     continue
+                if url in seen_payloads:
+                    continue
+                if new_payloads is not None:
+                    new_payloads.add(url)
                 if full_url:
                     codes.add(url)
                 else:
-                    # Extract substring after last slash via regex
-                    match = re.search(r'[^/]+$', url.strip())
-                    if not match:
+                    # Extract substring after last slash
+                    code = url.strip().rsplit('/', 1)[-1]
+                    if code in known_codes:
                         continue
-                    code = match.group(0)
-                    if code_regex.fullmatch(code):
+                    if code and code_match(code):
                         codes.add(code)
     return codes
 
+DEFAULT_PATTERN = r'[A-Z0-9]{6,}'
+
+def _match_default_pattern(code):
+    """
+    Fast check for DEFAULT_PATTERN using str methods only: accepts ASCII letters and digits only.
+    Unlike the case-insensitive regex, it rejects non-ASCII case variants such as the
+    Kelvin sign, long s or dotless i.
+    """
+    return len(code) >= 6 and code.isascii() and code.isalnum()
+
+def make_code_matcher(pattern, use_re2=False):
+    """
+    Return a callable that tests whether a code segment fully matches pattern,
+    case-insensitively. The default pattern gets a regex-free fast path; other
+    patterns are compiled with re.IGNORECASE and applied with fullmatch().
+    If use_re2 is True and the pattern is RE2-compatible, RE2 is used instead; note
+    that RE2's \\d, \\w and \\b only match ASCII, unlike Python's re.
+    Raises re.error for an invalid pattern.
+    """
+    if pattern == DEFAULT_PATTERN:
+        return _match_default_pattern
+    if use_re2:
+        options = re2.Options()
+        options.case_sensitive = False
+        options.log_errors = False
+        try:
+            return re2.compile(pattern, options=options).fullmatch
+        except re2.error:
+            pass  # e.g. backreferences, which RE2 does not support
+    return re.compile(pattern, re.IGNORECASE).fullmatch
+
+def luminance(value):
+    """argparse type for a pixel luminance between 0 and 255."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid int value: {value!r}')
+    if not 0 <= number <= 255:
+        raise argparse.ArgumentTypeError(f'must be between 0 and 255, got {number}')
+    return number
+
 def main():
     parser = argparse.ArgumentParser(description='Scan Zyn container codes from video')
     parser.add_argument('--video', required=True, help='Path to input video file')
     parser.add_argument('--interval', type=int, default=10,
                         help='Process every Nth frame (default: 10)')
-    parser.add_argument('--pattern', default=r'[A-Z0-9]{6,}',
-                        help='Regex pattern for codes (default: [A-Z0-9]{6,}), applied case-insensitively')
+    parser.add_argument('--pattern', default=DEFAULT_PATTERN,
+                        help=f'Regex pattern for codes (default: {DEFAULT_PATTERN}), applied case-insensitively')
     parser.add_argument('--output', help='Write unique codes to this file')
     parser.add_argument('--full-url', action='store_true',
                         help='Store the full decoded URL instead of just the code segment')
@@ -128,12 +306,20 @@ def main():
                         help='Show debug output: bounding boxes and decoded data for each frame')
     parser.add_argument('--upsample', type=int, default=1,
                         help='Upsample factor for frames before QR decode (default: 1)')
+    parser.add_argument('--threshold', type=luminance,
+                        help='Binarize frames at this luminance (0-255) before QR decode (default: off)')
+    parser.add_argument('--re2', action='store_true',
+                        help='Match a custom --pattern with RE2 (requires google-re2); '
+                             'RE2 treats \\d, \\w and \\b as ASCII-only')
     args = parser.parse_args()
 
-    # Compile code regex (for the tail of URL)
+    # Build the code matcher (for the tail of URL)
+    if args.re2 and not have_re2:
+        print("Error: --re2 requires the re2 module; install with 'pip install google-re2'", file=sys.stderr)
+        sys.exit(1)
     try:
-        # Compile regex for code matching, case-insensitive by default
-        code_regex = re.compile(args.pattern, re.IGNORECASE)
+        # Regex for code matching, case-insensitive by default
+        code_match = make_code_matcher(args.pattern, use_re2=args.re2)
     except re.error as e:
         print(f'Invalid regex pattern: {e}', file=sys.stderr)
         sys.exit(1)
@@ -145,60 +331,110 @@ def main():
         sys.exit(1)
 
     unique_codes = set()
-    frame_idx = 0
-    print('Scanning video for codes...')
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
-        frame_idx += 1
-        if frame_idx % args.interval != 0:
-            continue
-        # Debug visualization: show detected QR boxes and data
-        if args.debug:
-            dbg = frame.copy()
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            if have_pyzbar:
-                # Only decode QR codes in debug mode
-                objs = pyzbar_decode(gray, symbols=[ZBarSymbol.QRCODE])
-                print(f"[Debug] Frame {frame_idx}: {len(objs)} QR codes decoded")
-                for obj in objs:
-                    x, y, w, h = obj.rect
-                    cv2.rectangle(dbg, (x, y), (x+w, y+h), (0,255,0), 2)
-                    txt = obj.data.decode('utf-8', errors='ignore')
-                    cv2.putText(dbg, txt, (x, y-10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,255,0), 1)
-            else:
-                ok, pts = detector_cv.detect(frame)
-                print(f"[Debug] Frame {frame_idx}: OpenCV detect {'ok' if ok else 'fail'}")
-                if ok and pts is not None:
-                    for quad in pts:
-                        pts_int = quad.astype(int)
-                        cv2.polylines(dbg, [pts_int], True, (255,0,0), 2)
-            cv2.imshow('Debug', dbg)
-            if cv2.waitKey(1) & 0xFF == ord('q'):
-                args.debug = False
-                cv2.destroyWindow('Debug')
-        # Detect QR codes and extract reward code after last slash
-        codes = extract_codes_from_frame(frame, code_regex, args.full_url, args.upsample)
+    # Raw QR payloads already parsed. Workers only read it; payloads are recorded
+    # here as results are consumed in frame order, so a payload is only skipped
+    # if an earlier frame already produced it
+    seen_payloads = set()
+
+    def record_codes(codes, payloads):
+        seen_payloads.update(payloads)
         new_codes = codes - unique_codes
         if new_codes:
-            for code in sorted(new_codes):
+            for code in new_codes:
                 print('Found code:', code)
             unique_codes.update(new_codes)
+
+    # Decode frames on a thread pool so QR decoding overlaps with video decoding.
+    # pyzbar calls libzbar through ctypes, which releases the GIL; the shared
+    # OpenCV QRCodeDetector is not thread-safe, so the fallback decodes inline.
+    workers = os.cpu_count() or 1
+    max_pending = 2 * workers
+    pending = deque()
+    frame_idx = 0
+    print('Scanning video for codes...')
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            # Grab every frame but only decode the ones we process
+            if not cap.grab():
+                break
+            frame_idx += 1
+            if frame_idx % args.interval != 0:
+                continue
+            ret, frame = cap.retrieve()
+            if not ret:
+                break
+            gray = None
+            # Debug visualization: show detected QR boxes and data
+            if args.debug:
+                # Only copy the frame if there is something to draw on it; frame
+                # itself is still handed to the decoder below
+                dbg = frame
+                if have_pyzbar:
+                    # Convert once here and share it with the decode below
+                    gray = frame_to_gray(frame, args.threshold)
+                    # Only decode QR codes in debug mode
+                    objs = pyzbar_decode(gray, symbols=[ZBarSymbol.QRCODE])
+                    print(f"[Debug] Frame {frame_idx}: {len(objs)} QR codes decoded")
+                    if objs:
+                        dbg = frame.copy()
+                    for obj in objs:
+                        x, y, w, h = obj.rect
+                        cv2.rectangle(dbg, (x, y), (x+w, y+h), (0,255,0), 2)
+                        txt = obj.data.decode('utf-8', errors='ignore')
+                        cv2.putText(dbg, txt, (x, y-10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,255,0), 1)
+                else:
+                    if args.threshold is not None:
+                        # Detect on the same binarized image the decode below uses
+                        gray = frame_to_gray(frame, args.threshold)
+                    ok, pts = detector_cv.detect(frame if gray is None else gray)
+                    print(f"[Debug] Frame {frame_idx}: OpenCV detect {'ok' if ok else 'fail'}")
+                    if ok and pts is not None:
+                        dbg = frame.copy()
+                        for quad in pts:
+                            pts_int = quad.astype(int)
+                            cv2.polylines(dbg, [pts_int], True, (255,0,0), 2)
+                cv2.imshow('Debug', dbg)
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    args.debug = False
+                    cv2.destroyWindow('Debug')
+            # Detect QR codes and extract reward code after last slash
+            frame_payloads = set()
+            if not have_pyzbar:
+                record_codes(extract_codes_from_frame(frame, code_match, args.full_url, args.upsample,
+                                                      gray=gray, known_codes=unique_codes, threshold=args.threshold,
+                                                      seen_payloads=seen_payloads,
+                                                      new_payloads=frame_payloads),
+                             frame_payloads)
+                continue
+            future = executor.submit(extract_codes_from_frame, frame, code_match,
+                                     args.full_url, args.upsample, gray=gray,
+                                     known_codes=unique_codes, threshold=args.threshold,
+                                     seen_payloads=seen_payloads, new_payloads=frame_payloads)
+            pending.append((future, frame_payloads))
+            # Bound the frames in flight; results are consumed in frame order
+            if len(pending) >= max_pending:
+                future, frame_payloads = pending.popleft()
+                record_codes(future.result(), frame_payloads)
+        while pending:
+            future, frame_payloads = pending.popleft()
+            record_codes(future.result(), frame_payloads)
+    if have_pyzbar:
+        # The worker threads have exited; free their ZBar scanners and images
+        release_zbar_scanners()
     cap.release()
     # Output results
     print(f'Total unique codes: {len(unique_codes)}')
+    # Sort once and emit everything in a single write
+    lines = ''.join(code + '\n' for code in sorted(unique_codes))
     if args.output:
         try:
             with open(args.output, 'w') as f:
-                for code in sorted(unique_codes):
-                    f.write(code + '\n')
+                f.write(lines)
             print(f'Codes written to {args.output}')
         except IOError as e:
             print(f'Error writing to output file: {e}', file=sys.stderr)
     else:
-        for code in sorted(unique_codes):
-            print(code)
+        sys.stdout.write(lines)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -8,11 +8,29 @@ import os
 import sys
 import argparse
 import getpass
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
 from urllib.parse import urljoin
 
+# Prefer the C-based lxml parser for BeautifulSoup; fall back to the stdlib parser
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+# Optional HTTP/2 client: httpx multiplexes concurrent submissions over one connection
+try:
+    import httpx
+    import h2  # noqa: F401  (required by httpx for http2=True)
+    HAVE_HTTPX = True
+except ImportError:
+    HAVE_HTTPX = False
+
 # Optional Selenium-based browser automation
 try:
     import time
@@ -27,6 +45,21 @@ try:
 except ImportError:
     HAVE_SELENIUM = False
 
+def make_session(workers):
+    """
+    Create the HTTP client used for login and submission: an HTTP/2 httpx.Client
+    if httpx[http2] is installed, otherwise a requests.Session whose connection
+    pool is sized for 'workers' concurrent submissions. Both follow redirects.
+    """
+    if HAVE_HTTPX:
+        return httpx.Client(http2=True, follow_redirects=True, timeout=30.0,
+                            limits=httpx.Limits(max_connections=workers))
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
 def parse_form(session, url):
     """
     Fetch the page at 'url', parse the first <form>, and return
@@ -34,7 +67,7 @@ def parse_form(session, url):
     """
     resp = session.get(url)
     resp.raise_for_status()
-    soup = BeautifulSoup(resp.text, 'html.parser')
+    soup = BeautifulSoup(resp.text, HTML_PARSER)
     form = soup.find('form')
     if form is None:
         raise RuntimeError(f'No <form> found at {url}')
@@ -74,13 +107,13 @@ def login(session, login_url, username, password, verbose=False):
         sys.exit(1)
     # Submit login form and follow redirects to landing page
     # Submit login form and follow redirects, include Referer for anti-forgery
-    resp = session.post(action_url, data=form_data, allow_redirects=True,
-                        headers={'Referer': login_url})
+    resp = session.post(action_url, data=form_data, headers={'Referer': login_url})
     resp.raise_for_status()
-    if login_url in resp.url or 'login' in resp.url.lower():
+    final_url = str(resp.url)
+    if login_url in final_url or 'login' in final_url.lower():
         print('Warning: login may have failed (still on login page)', file=sys.stderr)
     elif verbose:
-        print('Login succeeded, redirected to', resp.url)
+        print('Login succeeded, redirected to', final_url)
     return session
 
 def submit_code(session, submit_url, code, verbose=False):
@@ -89,6 +122,16 @@ def submit_code(session, submit_url, code, verbose=False):
     Returns True on likely success, False otherwise.
     """
     action_url, form_data = parse_form(session, submit_url)
+    return bool(submit_code_cached(session, action_url, form_data, code, submit_url, verbose=verbose))
+
+def submit_code_cached(session, action_url, base_form_data, code, referer, verbose=False):
+    """
+    Submit a single reward code by POSTing a copy of an already-parsed form
+    (as returned by parse_form) to action_url.
+    Returns True on likely success, False otherwise, or None if the server
+    rejected the form (400/403), e.g. because its anti-forgery token is stale.
+    """
+    form_data = dict(base_form_data)
     # Inject the code
     if 'code' in form_data:
         form_data['code'] = code
@@ -104,8 +147,11 @@ def submit_code(session, submit_url, code, verbose=False):
             form_data['code'] = code
     # Submit reward code form and follow redirects to confirmation page
     # Submit reward code form and follow redirects, include Referer for anti-forgery
-    resp = session.post(action_url, data=form_data, allow_redirects=True,
-                        headers={'Referer': submit_url})
+    resp = session.post(action_url, data=form_data, headers={'Referer': referer})
+    if resp.status_code in (400, 403):
+        if verbose:
+            print(f'Code {code} rejected with HTTP {resp.status_code}; form may be stale')
+        return None
     resp.raise_for_status()
     text = resp.text.lower()
     if 'thank' in text or 'success' in text:
@@ -220,6 +266,16 @@ def submit_codes_browser(login_url, submit_url, codes, username, password, dry_r
     finally:
         driver.quit()
 
+def positive_int(value):
+    """argparse type for integer options that must be at least 1."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid int value: {value!r}')
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1, got {number}')
+    return number
+
 def main():
     parser = argparse.ArgumentParser(description='Submit Zyn reward codes to your account')
     parser.add_argument(
@@ -237,6 +293,8 @@ def main():
     parser.add_argument('--password', help='Account password (or set ZYN_PASSWORD env var)')
     parser.add_argument('--dry-run', action='store_true', help="Don't actually submit, just print codes")
     parser.add_argument('--browser', action='store_true', help='Use Selenium browser automation for submission')
+    parser.add_argument('--workers', type=positive_int, default=8,
+                        help='Number of concurrent HTTP submissions (default: %(default)s)')
     parser.add_argument('--verbose', action='store_true', help='Enable verbose output')
     args = parser.parse_args()
 
@@ -273,18 +331,45 @@ def main():
         )
     else:
         # HTTP-based submission
-        session = requests.Session()
+        session = make_session(args.workers)
         login(session, args.login_url, username, password, verbose=args.verbose)
         print(f'Submitting {len(codes)} codes...')
-        for code in codes:
-            if args.dry_run:
+        if args.dry_run:
+            for code in codes:
                 print('[DRY-RUN] Would submit:', code)
-                continue
-            try:
-                ok = submit_code(session, args.submit_url, code, verbose=args.verbose)
-                print(f'{code}: {"OK" if ok else "FAIL"}')
-            except Exception as e:
-                print(f'{code}: ERROR ({e})')
+            return
+        # Fetch and parse the submission form once; re-fetch only if it goes stale
+        try:
+            form = parse_form(session, args.submit_url)
+        except Exception as e:
+            print(f'Could not load submission form: {e}', file=sys.stderr)
+            sys.exit(1)
+        form_lock = threading.Lock()
+
+        def submit_one(code):
+            nonlocal form
+            current = form
+            ok = submit_code_cached(session, *current, code, args.submit_url, verbose=args.verbose)
+            if ok is None:
+                # Form rejected (e.g. expired anti-forgery token): refresh and retry once
+                with form_lock:
+                    # Another thread may already have refreshed it
+                    if form is current:
+                        form = parse_form(session, args.submit_url)
+                    current = form
+                ok = submit_code_cached(session, *current, code, args.submit_url, verbose=args.verbose)
+            return ok
+
+        # Submissions are network-bound, so overlap them on threads sharing the session
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            futures = {executor.submit(submit_one, code): code for code in codes}
+            for future in as_completed(futures):
+                code = futures[future]
+                try:
+                    ok = future.result()
+                    print(f'{code}: {"OK" if ok else "FAIL"}')
+                except Exception as e:
+                    print(f'{code}: ERROR ({e})')
 
 if __name__ == '__main__':
     main()
\ No newline at end of file